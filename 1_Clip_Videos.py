@@ -7,6 +7,8 @@
 # Requirements:
 #   Requires ffmpeg command line tool to capture images,
 #   Download at https://ffmpeg.org/
+#   Optionally uses PyAV to read video durations without ffprobe,
+#   Install with pip install av
 #   Python version 3.9.12
 #
 # Description:
@@ -32,8 +34,17 @@ import os
 from datetime import datetime
 from datetime import timedelta
 import subprocess
+from concurrent.futures import ProcessPoolExecutor
 import csv
-import re
+import math
+import json
+import atexit
+
+# PyAV is optional, used to read video durations without calling ffprobe
+try:
+    import av
+except ImportError:
+    av = None
 
 
 ###################################################################
@@ -60,36 +71,49 @@ end = 12 # column with end time in UTC
 #   Set-up
 ###################################################################
 
-# Function to convert a csv file into dictionaries
-def csv_dict(variables_file, col1, col2):
-    # Load csv and create a dictionary
+# Function to convert a csv file into two dictionaries sharing a key column
+def csv_dicts(variables_file, col1, col2, col3):
+    # Load csv once, skip header row and create both dictionaries
+    dict1 = dict()
+    dict2 = dict()
     with open(variables_file, mode='r') as infile:
         reader = csv.reader(infile, delimiter=',')
-        dict_list = {rows[col1-1]:rows[col2-1] for rows in reader}
-        return dict_list
-
-# Calls to csv_dict,
-# returns dictionary of video filenames and start times and end times
-startsDict = csv_dict(divelog, dive, start)
-startsDict.pop('Dive_Name', None)
-endsDict = csv_dict(divelog, dive, end)
-endsDict.pop('Dive_Name', None)
-
-# Create directory to save images if it doesn't exist
-outputdir = 'Video_clips'
-if not os.path.exists(outputdir):
-    os.makedirs(outputdir)
-
-
-###################################################################
-#   Loop through each video file and clip
-###################################################################
-
-# List video files
-videofiles = os.listdir(videopath)
-
-# Loop through each video file
-for video in videofiles:
+        next(reader, None)
+        for rows in reader:
+            dict1[rows[col1-1]] = rows[col2-1]
+            dict2[rows[col1-1]] = rows[col3-1]
+    return dict1, dict2
+
+# Function to read duration of video file in seconds,
+# uses PyAV if installed and falls back to ffprobe
+def probe_duration(path):
+    if av is not None:
+        try:
+            with av.open(path) as container:
+                if container.duration is not None:
+                    return container.duration / av.time_base
+        except Exception:
+            pass
+    durcall = ['ffprobe', '-v', 'error', '-show_entries', 'format=duration', '-of', 'default=nw=1:nk=1', path]
+    durproc = subprocess.run(durcall, capture_output=True, text=True)
+    return float(durproc.stdout)
+
+# Function to get duration of video file in seconds,
+# only probes if the file is not already in the duration cache
+def get_duration(path):
+    st = os.stat(path)
+    key = os.path.basename(path) + '|' + str(st.st_size) + '|' + str(int(st.st_mtime))
+    if key not in durcache:
+        durcache[key] = probe_duration(path)
+    return durcache[key]
+
+# Function to save the duration cache, called on exit
+def save_durcache():
+    with open(durcachefile, 'w') as outfile:
+        json.dump(durcache, outfile)
+
+# Function to build the ffmpeg clip call for one video file
+def clip_one(video):
 
     # Parse video filename
     parts = video.split('_')
@@ -122,35 +146,81 @@ for video in videofiles:
     elapsedSecs = transectStartDateTime - videoStartDateTime
 
     # Get duration of video file in seconds
-    durcall = ('ffprobe -v error -show_entries format=duration ' + videopath + '/' + video )
-    durproc = subprocess.run(durcall, shell=True, capture_output=True, text=True)
-    dur = float(re.sub('[^0-9.]', '', durproc.stdout))
+    dur = get_duration(videopath + '/' + video)
 
     # Original video file should end after end of transect in dive log, check:
     elapsedSecs_endtransect = (transectEndDateTime - videoStartDateTime).seconds
     if elapsedSecs_endtransect > dur:
         print("Warning! Transect " + divename + " ends after the video file finishes")
 
-    # Clip videos while elpased time is less than duration
-    while elapsedSecs.seconds < elapsedSecs_endtransect:
+    # Number of clips needed to cover the transect, in seconds per clip
+    clipsecs = int(clipsize) * 60
+    nclips = math.ceil((elapsedSecs_endtransect - elapsedSecs.seconds) / clipsecs)
+
+    # Temporary names for the segments written by ffmpeg
+    segmentname = outputdir + '/' + video.split('.')[0] + '_segment_%03d.mp4'
+
+    # Clip video into all segments with a single ffmpeg call,
+    # segments are split on keyframes so no buffer is needed against jumpy video,
+    # faststart moves the moov index to the head of each clip for fast probing and seeking
+    clipcall = ['ffmpeg', '-nostdin', '-hide_banner', '-loglevel', 'error', '-ss', str(elapsedSecs), '-i', videopath + '/' + video, '-t', str(nclips * clipsecs),
+                '-vcodec', 'copy', '-acodec', 'copy', '-f', 'segment', '-segment_time', str(clipsecs), '-segment_format', 'mp4', '-segment_format_options', 'movflags=+faststart', '-reset_timestamps', '1', segmentname]
+
+    # Start list to append segment and video clip file names
+    renames = list()
+    for i in range(nclips):
 
         # Video clip file name
-        starttime = videoStartDateTime + elapsedSecs
+        starttime = videoStartDateTime + elapsedSecs + timedelta(seconds=i * clipsecs)
         strstarttime = starttime.strftime('%Y%m%d_%H%M%S')
         clipname = outputdir +'/'+ tripid +'_'+ divename + '_' + strstarttime + '.mp4'
+        renames.append((segmentname % i, clipname))
+
+    return video, clipcall, renames
+
+# Function to run the ffmpeg clip call for one video and rename its segments,
+# used by the process pool
+def run_ffmpeg(task):
+    video, clipcall, renames = task
+    clipproc = subprocess.run(clipcall, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    if clipproc.returncode != 0:
+        print("Warning! ffmpeg failed while clipping " + video)
+    # Rename segments using the same format as the input videos
+    for segment, clipname in renames:
+        if os.path.exists(segment):
+            os.replace(segment, clipname)
+
+
+###################################################################
+#   Loop through each video file and clip
+###################################################################
+
+# Guard needed so worker processes can import this script on Windows
+if __name__ == '__main__':
+
+    # Call to csv_dicts,
+    # returns dictionaries of video filenames and start times and end times
+    startsDict, endsDict = csv_dicts(divelog, dive, start, end)
+
+    # Create directory to save images if it doesn't exist
+    outputdir = 'Video_clips'
+    if not os.path.exists(outputdir):
+        os.makedirs(outputdir)
+
+    # Load duration cache, saved alongside the video clips on exit
+    durcachefile = outputdir + '/.durations.json'
+    durcache = dict()
+    if os.path.exists(durcachefile):
+        with open(durcachefile, mode='r') as infile:
+            durcache = json.load(infile)
+    atexit.register(save_durcache)
+
+    # List video files, skipping any other files in the folder
+    videofiles = [e.name for e in os.scandir(videopath) if e.is_file() and e.name.lower().endswith('.mp4')]
+
+    # Build the clip call for each video file up front
+    tasks = [clip_one(video) for video in videofiles]
 
-        # Clip video 
-        if elapsedSecs.total_seconds() > 5: # to buffer against copy issue with often leaves 5 seconds of jumpy video
-            elapsedtime = elapsedSecs - timedelta(seconds=5)
-            elapsedtime = str(elapsedtime)
-            clipcall = ('ffmpeg -ss ' + elapsedtime + ' -i ' + videopath + '/' + video + ' -t 00:' + clipsize + ':05 -vcodec copy -acodec copy ' + clipname)
-            subprocess.call(clipcall, shell = True)
-        else:
-            elapsedtime = str(elapsedSecs)
-            clipcall = ('ffmpeg -ss ' + elapsedtime + ' -i ' + videopath + '/' + video + ' -t 00:' + clipsize + ':00 -vcodec copy -acodec copy ' + clipname)
-            subprocess.call(clipcall, shell = True) 
-
-        # Add to elapsed seconds
-        elapsedSecs = elapsedSecs + timedelta(minutes=int(clipsize))
-
-        
+    # Run the clip calls in parallel, one ffmpeg process per core
+    with ProcessPoolExecutor(max_workers=os.cpu_count()) as executor:
+        list(executor.map(run_ffmpeg, tasks))
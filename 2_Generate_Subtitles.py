@@ -7,6 +7,8 @@
 # Requirements:
 #   Requires ffmpeg command line tool to capture images,
 #   Download at https://ffmpeg.org/
+#   Optionally uses PyAV to read video durations without ffprobe,
+#   Install with pip install av
 #   Python version 3.9.12
 #
 # Description:
@@ -30,9 +32,19 @@
 
 import os
 import subprocess
+import json
+import atexit
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
 import pandas as pd
+import numpy as np
 import re
 
+# PyAV is optional, used to read video durations without calling ffprobe
+try:
+    import av
+except ImportError:
+    av = None
+
 
 ###################################################################
 #   Inputs
@@ -41,7 +53,7 @@ import re
 
 # Folder name with video clips, full path if not within current wd
 # Video files must be named: TripID_DiveID_YYYYMMDD_HHMMSS.mp4
-# No other files can be in this folder, including other subtitle files
+# Only .mp4 files in this folder are read, other files are skipped
 videopath = 'Video_clips'
 
 # CSV output from ROV tracking data processing, for all transects
@@ -56,26 +68,56 @@ names = ['Datetime','Dive_Name','ROV_Longitude_loess','ROV_Latitude_loess','Dept
 #   Set-up
 ###################################################################
 
-# Load tracking data and subset columns
-data = pd.read_csv(csvfile)
-data = data[names]
-
-# Format datetime from data
-data['Datetime'] = pd.to_datetime(data['Datetime'], format='%Y-%m-%d %H:%M:%S')
-# Format time from datetime
-data['Time'] = data['Datetime'].dt.time
-names.insert(1, 'Time')
-data = data[names]
-
-###################################################################
-#   Loop through each video file and generate subtitles
-# ###################################################################
-
-# List video files
-videofiles = os.listdir(videopath)
-
- # Loop through each video file
-for video in videofiles:
+# Function to read duration of video file in seconds,
+# uses PyAV if installed and falls back to ffprobe
+def probe_duration(path):
+    if av is not None:
+        try:
+            with av.open(path) as container:
+                if container.duration is not None:
+                    return container.duration / av.time_base
+        except Exception:
+            pass
+    durcall = ['ffprobe', '-v', 'error', '-show_entries', 'format=duration', '-of', 'default=nw=1:nk=1', path]
+    durproc = subprocess.run(durcall, capture_output=True, text=True)
+    return float(durproc.stdout)
+
+# Function to get duration of video file in seconds,
+# only probes if the file is not already in the duration cache
+def get_duration(path):
+    st = os.stat(path)
+    key = os.path.basename(path) + '|' + str(st.st_size) + '|' + str(int(st.st_mtime))
+    if key not in durcache:
+        durcache[key] = probe_duration(path)
+    return durcache[key]
+
+# Function to save the duration cache, called on exit
+def save_durcache():
+    with open(durcachefile, 'w') as outfile:
+        json.dump(durcache, outfile)
+
+# Filter names to simplify, remove "ROV" and Loess and units after underscores,
+# time field is added after datetime when the tracking data is loaded
+newnames = [n.replace('ROV_', '').replace('loess', '').split('_')[0] for n in names]
+newnames.insert(1, 'Time')
+
+# Standard fields (lat, lon and time) and other fields, excluding dive and datetime
+stdregex = re.compile('.*Lat|.*Lon|.*Time')
+stdfields = list(filter(stdregex.match, newnames))
+othercols = [n for n in newnames if n not in stdfields + ['Dive', 'Datetime']]
+
+# Subtitle template, with a line for standard fields and a line for other fields
+template = ('{idx}\n{t0} --> {t1}\n' + ''.join(f'{s}: {{{s}}}   ' for s in stdfields) + '\n' +
+            ''.join(f'{o}: {{{o}}}   ' for o in othercols) + '\n\n')
+
+# Function to set the dive groups in each worker process
+def init_worker(groups):
+    global dive_groups
+    dive_groups = groups
+
+# Function to generate the subtitles for one video file,
+# returns the subtitle file name and text, or None if the dive is not found
+def make_srt(video, dur):
 
     # Parse video filename
     parts = video.split('_')
@@ -86,58 +128,94 @@ for video in videofiles:
      # Format start datetime of video
     videoStartDateTime = pd.to_datetime(videostart, format='%Y%m%d_%H%M%S')
     
-    # Get duration of video file in seconds, add a one second buffer
-    durcall = ('ffprobe -v error -show_entries format=duration ' + videopath + '/' + video )
-    durproc = subprocess.run(durcall, shell=True, capture_output=True, text=True)
-    dur = float(re.sub('[^0-9.]', '', durproc.stdout)) + 1
+    # Add a one second buffer to duration of video file
+    dur = dur + 1
 
     # Calculate datetime at end of video clip
     videoEndDateTime = videoStartDateTime + pd.Timedelta(seconds=int(dur))
     # Subset rows by dive name
-    divedata = data.loc[data['Dive_Name'] == divename]
-    divedata = divedata.reset_index(drop=True)
+    divedata = dive_groups.get(divename)
+    if divedata is None:
+        print("Warning! Dive " + divename + " is not found in the tracking data")
+        return None
+
+    # Subset data by datetime of video, binary search on the sorted datetimes
+    dt = divedata['Datetime'].to_numpy()
+    start = videoStartDateTime.to_datetime64()
+    lo = np.searchsorted(dt, start, side='left')
+    hi = np.searchsorted(dt, videoEndDateTime.to_datetime64(), side='right')
+    vdata = divedata.iloc[lo:hi]
+
+    # Format elapsed time from start of video as hh:mm:ss
+    secs = (dt[lo:hi] - start) // np.timedelta64(1, 's')
+    hours, rem = np.divmod(secs, 3600)
+    mins, secs = np.divmod(rem, 60)
+    times = [f'{h:02d}:{m:02d}:{sec:02d}' for h, m, sec in zip(hours, mins, secs)]
+
+    # Convert fields to strings once, as one record per row
+    records = vdata[stdfields + othercols].astype(str).to_dict('records')
+
+    # Create subtitles, fill the template for all rows except the last
+    strlist = [template.format(idx=i+1, t0=times[i], t1=times[i+1], **records[i]) for i in range(len(records) - 1)]
 
-    # Subset data by datetime of video
-    vdata = divedata.loc[divedata['Datetime'] >= videoStartDateTime]
-    vdata = vdata.loc[vdata['Datetime'] <= videoEndDateTime]
-    vdata = vdata.reset_index(drop=True)
+    # Subtitle file name
+    sfile = videopath + '/' + video.split('.')[0] + '.srt'
+
+    # Encode subtitles here so the main process only writes bytes
+    return sfile, ''.join(strlist).encode('utf-8')
 
-    # Filter names to simplify, remove "ROV" and Loess and units after underscores
-    newnames = [re.sub('ROV_|loess', '', n) for n in names]
-    newnames = [re.sub('_.*', '', n) for n in newnames]
-    vdata.columns = newnames
+
+###################################################################
+#   Loop through each video file and generate subtitles
+###################################################################
+
+# Guard needed so worker processes can import this script on Windows
+if __name__ == '__main__':
+
+    # Load duration cache, saved alongside the video clips on exit
+    durcachefile = videopath + '/.durations.json'
+    durcache = dict()
+    if os.path.exists(durcachefile):
+        with open(durcachefile, mode='r') as infile:
+            durcache = json.load(infile)
+    atexit.register(save_durcache)
+
+    # Load tracking data, reading only the subset columns and formatting datetime
+    data = pd.read_csv(csvfile, usecols=names, parse_dates=['Datetime'], dtype={'Dive_Name': 'category'})
+    data = data[names]
+
+    # Format time from datetime, as strings so they are not converted per video
+    data['Time'] = data['Datetime'].dt.strftime('%H:%M:%S')
+    names.insert(1, 'Time')
+    data = data[names]
+
+    # Simplify column names
+    data.columns = newnames
 
     # Round all fields except for lat and lon fields and dive and datetime
-    r = re.compile('.*Lat|.*Lon|.*Time')
-    stdfields = list(filter(r.match, newnames)) 
-    othercols = list(set(newnames) - set(stdfields + list(['Dive', 'Datetime'])))
-    # Round other columns to 1 decimal
-    vdata[othercols] = vdata[othercols].round(decimals=1)
+    # Round other columns to 1 decimal, as float32 which holds 1 decimal values
+    data[othercols] = data[othercols].astype('float32').round(decimals=1)
     # Round standard columns (lat/lon) to 5 decimals
-    vdata[stdfields] = vdata[stdfields].round(decimals=5)
+    data[stdfields] = data[stdfields].round(decimals=5)
 
-    # Add elapse time field
-    vdata['elapsed'] = vdata['Datetime'] - videoStartDateTime
-    vdata['elapsedstr'] = vdata['elapsed'].astype(str).str.split(' ').str[-1]
-    
-    # Start list to append line
-    strlist = list()
-
-    # Create subtitles, loop through all rows except the last
-    for i in vdata.iloc[:-1].index:
-        strlist.append( f'{i+1}\n' )
-        strlist.append( f'{vdata["elapsedstr"][i]} --> {vdata["elapsedstr"][i+1]}\n' )
-        # Add line for standard fields
-        for s in stdfields:
-            strlist.append( f'{s}: {str(vdata[s][i])}   ' )
-        strlist.append( f'\n' )
-        # Add line for other fields
-        for o in othercols:
-            strlist.append( f'{o}: {str(vdata[o][i])}   ' )
-        strlist.append( f'\n\n' )
+    # Split tracking data by dive once, sorted by datetime for fast subsetting
+    dive_groups = {k: g.sort_values('Datetime').reset_index(drop=True) for k, g in data.groupby('Dive', sort=False, observed=True)}
 
-    # Subtitle file name
-    sfile = videopath + '/' + video.split('.')[0] + '.srt'
-    # Write subtitles by iterating by rows of vdata
-    with open( sfile, 'w') as f:
-        f.writelines(strlist)
+    # List video files, skipping subtitle files and the duration cache
+    videofiles = [e.name for e in os.scandir(videopath) if e.is_file() and e.name.lower().endswith('.mp4')]
+
+    # Get duration of all video files in seconds, ffprobe calls overlap in threads
+    with ThreadPoolExecutor(max_workers=16) as executor:
+        durations = dict(zip(videofiles, executor.map(lambda v: get_duration(videopath + '/' + v), videofiles)))
+
+    # Generate subtitles for each video file in parallel, one worker per core
+    with ProcessPoolExecutor(max_workers=os.cpu_count(), initializer=init_worker, initargs=(dive_groups,)) as executor:
+        srts = executor.map(make_srt, videofiles, [durations[v] for v in videofiles])
+
+        # Write subtitles as one binary write per file, large writes bypass the buffer
+        for srt in srts:
+            if srt is None:
+                continue
+            sfile, buffer = srt
+            with open( sfile, 'wb') as f:
+                f.write(buffer)